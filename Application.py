@@ -7,12 +7,20 @@ from pydantic import BaseModel
 from starlette.requests import Request
 from starlette.responses import StreamingResponse
 
-from EdithCloudNacos import NacosClient
+from EdithCloudAgent import SharedNacosClient
 from RedisConfig import RedisConnectionConfigureFromNacosConfig, RedisTemplate
 from SaTokenAuthorize import SaTokenConfigureFromNacosConfig, SameTokenChecker
 
 app = FastAPI()
-nacos_client = NacosClient()
+# 多worker部署时同一主机只有一个进程访问Nacos，其余worker共享配置快照
+nacos_client = SharedNacosClient()
+
+
+@app.on_event('shutdown')
+def shutdownNacosClient():
+    # 停止配置监听线程，否则持锁的worker在退出时会一直等待长轮询
+    nacos_client.terminate()
+
 
 # 创建RedisTemplate和SaTokenAuthorize
 # saTokenConfigureFromNacosConfig = SaTokenConfigureFromNacosConfig(nacos_client)
@@ -0,0 +1,299 @@
+import getpass
+import json
+import mmap
+import os
+import struct
+from hashlib import sha1
+from tempfile import gettempdir
+from threading import Thread, Lock
+from time import sleep, monotonic
+from uuid import uuid4
+
+from EdithCloudNacos import NacosClient, ConfigCache, ImportConfig, PROPERTIES_PATH, CHARACTER, \
+    loadProperties, parseImportConfigs
+
+SNAPSHOT_MAGIC = b'EDCS'
+# magic, version, payload length
+SNAPSHOT_HEADER = struct.Struct('<4sQQ')
+SNAPSHOT_INIT_SIZE = 64 * 1024
+WATCH_INTERVAL = 1
+WAIT_SNAPSHOT_TIMEOUT = 30
+# 写者在写入中途退出时version会一直是奇数，读者最多等待这么久（秒）
+SNAPSHOT_READ_TIMEOUT = 1
+# Windows下锁住远离文件开头的字节，以免挡住其他进程读取agent写入的token
+LOCK_OFFSET = 1 << 20
+TOKEN_SIZE = 64
+
+try:
+    import fcntl
+
+
+    def tryLockFile(fd):
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+except ImportError:
+    import msvcrt
+
+
+    def tryLockFile(fd):
+        try:
+            os.lseek(fd, LOCK_OFFSET, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+
+def snapshotPath(properties: dict, properties_path: str):
+    """
+    按应用名、Nacos地址、命名空间和properties文件区分快照，放在当前用户独占的目录下
+    """
+    nacos = properties['spring']['cloud']['nacos']
+    name = properties['spring']['application']['name']
+    key = json.dumps([name, nacos['server-addr'], nacos['config']['namespace'], os.path.abspath(properties_path)])
+    user = os.getuid() if hasattr(os, 'getuid') else getpass.getuser()
+    directory = os.path.join(gettempdir(), f'edith-cloud-{user}')
+    os.makedirs(directory, 0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        if os.stat(directory).st_uid != os.getuid():
+            raise PermissionError(f'{directory} is not owned by the current user')
+        os.chmod(directory, 0o700)
+    return os.path.join(directory, f'{name}-{sha1(key.encode(CHARACTER)).hexdigest()[:16]}.snapshot')
+
+
+class ConfigSnapshot:
+    """
+    基于内存映射文件的配置快照，一个进程写入，同一主机上的其他进程读取。
+    version为奇数表示正在写入，读者在读取前后比较version以保证读到完整的快照。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+        self.mm = None
+        self.lock = Lock()
+
+    def __open(self, size=0):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        size = os.fstat(self.fd).st_size
+        if size < SNAPSHOT_HEADER.size:
+            return False
+        if self.mm is None or len(self.mm) != size:
+            if self.mm is not None:
+                self.mm.close()
+            self.mm = mmap.mmap(self.fd, size)
+        return True
+
+    def version(self):
+        with self.lock:
+            if not self.__open():
+                return 0
+            magic, version, _ = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+            return version if magic == SNAPSHOT_MAGIC else 0
+
+    def publish(self, configs: dict):
+        payload = json.dumps(configs).encode(CHARACTER)
+        with self.lock:
+            size = SNAPSHOT_HEADER.size + len(payload)
+            self.__open(max(size, SNAPSHOT_INIT_SIZE))
+            magic, version, _ = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+            if magic != SNAPSHOT_MAGIC:
+                version = 0
+            # 向上取偶数后加一，标记写入中
+            version += version % 2
+            SNAPSHOT_HEADER.pack_into(self.mm, 0, SNAPSHOT_MAGIC, version + 1, 0)
+            self.mm[SNAPSHOT_HEADER.size:size] = payload
+            SNAPSHOT_HEADER.pack_into(self.mm, 0, SNAPSHOT_MAGIC, version + 2, len(payload))
+            self.mm.flush()
+            return version + 2
+
+    def read(self, timeout=SNAPSHOT_READ_TIMEOUT):
+        """
+        :return: (version, {ConfigCache.id: config})，快照不存在或在timeout内读不到完整快照时version为0
+        """
+        deadline = monotonic() + timeout
+        with self.lock:
+            while True:
+                if monotonic() > deadline:
+                    return 0, {}
+                if not self.__open():
+                    return 0, {}
+                magic, version, length = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+                if magic != SNAPSHOT_MAGIC or version == 0:
+                    return 0, {}
+                if version % 2:
+                    sleep(0.001)
+                    continue
+                if SNAPSHOT_HEADER.size + length > len(self.mm):
+                    # 写者扩容了文件，重新映射
+                    self.__open()
+                    continue
+                payload = bytes(self.mm[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + length])
+                _, after, _ = SNAPSHOT_HEADER.unpack_from(self.mm, 0)
+                if after == version:
+                    return version, json.loads(payload.decode(CHARACTER))
+
+    def close(self):
+        with self.lock:
+            if self.mm is not None:
+                self.mm.close()
+                self.mm = None
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+class SharedNacosClient(NacosClient):
+    """
+    多worker部署时共享配置的NacosClient，同一主机上只有持有锁的进程（agent）访问Nacos并监听配置，
+    并把配置发布到内存映射快照；其余worker只读取快照，agent退出后由其中一个worker接替。
+    agent持锁后把token写入锁文件，worker只接受token一致且包含全部导入配置的快照，以免读到上次运行残留的快照。
+    """
+
+    def __init__(self, properties_path=PROPERTIES_PATH, snapshot_path=None,
+                 watch_interval=WATCH_INTERVAL, **kwargs):
+        """
+        :param snapshot_path: 快照文件路径，默认由snapshotPath根据properties生成
+        """
+        properties = loadProperties(properties_path)
+        self.snapshot_ids = {ConfigCache.composeId(ic) for ic in parseImportConfigs(properties)}
+        if snapshot_path is None:
+            snapshot_path = snapshotPath(properties, properties_path)
+        self.snapshot = ConfigSnapshot(snapshot_path)
+        self.watch_interval = watch_interval
+        self.watcher = None
+        self.watching = False
+        self.snapshot_version = 0
+        self.snapshot_configs = {}
+        self.lock_fd = os.open(snapshot_path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        self.agent_token = None
+        self.is_agent = self.holding_lock = tryLockFile(self.lock_fd)
+        if self.is_agent:
+            self.__claim()
+        else:
+            self.__wait_snapshot()
+
+        super().__init__(properties_path, **kwargs)
+
+        if self.is_agent:
+            self.__become_agent()
+        self.active_config_listener()
+
+    def __claim(self):
+        self.agent_token = f'{os.getpid()}-{uuid4().hex}'
+        os.ftruncate(self.lock_fd, 0)
+        os.lseek(self.lock_fd, 0, os.SEEK_SET)
+        os.write(self.lock_fd, self.agent_token.encode(CHARACTER))
+
+    def __read_token(self):
+        os.lseek(self.lock_fd, 0, os.SEEK_SET)
+        return os.read(self.lock_fd, TOKEN_SIZE).decode(CHARACTER)
+
+    def __read_snapshot(self):
+        """
+        :return: 快照属于当前agent且包含全部导入配置时返回(version, configs)，否则configs为None
+        """
+        version, payload = self.snapshot.read()
+        token = self.__read_token()
+        if not version or not token or payload.get('agent') != token:
+            return version, None
+        configs = payload.get('configs', {})
+        if not self.snapshot_ids <= configs.keys():
+            return version, None
+        return version, configs
+
+    def __wait_snapshot(self):
+        deadline = monotonic() + WAIT_SNAPSHOT_TIMEOUT
+        while True:
+            if tryLockFile(self.lock_fd):
+                # agent在发布快照前就退出了，由当前worker接替
+                self.is_agent = self.holding_lock = True
+                self.__claim()
+                return
+            version, configs = self.__read_snapshot()
+            if configs is not None:
+                self.snapshot_version, self.snapshot_configs = version, configs
+                return
+            if monotonic() > deadline:
+                raise TimeoutError(f'Config snapshot {self.snapshot.path} was not published by the agent')
+            sleep(0.1)
+
+    def __become_agent(self):
+        for ic, cc in self.caches:
+            cc.add_feedback('agent', lambda _: self.publish_snapshot())
+        self.publish_snapshot()
+        # 守护线程，避免进程退出时等待长轮询结束
+        super().active_config_listener(daemon=True)
+
+    def publish_snapshot(self):
+        self.snapshot_version = self.snapshot.publish({'agent': self.agent_token,
+                                                       'configs': {cc.id: cc.config for cc in self.config_caches}})
+
+    def get_config_raw(self, import_config: ImportConfig, refresh=False):
+        if self.is_agent:
+            return super().get_config_raw(import_config, refresh)
+        return self.snapshot_configs[ConfigCache.composeId(import_config)]
+
+    def active_config_listener(self, daemon=True):
+        if self.watcher is None:
+            self.watching = True
+            self.watcher = Thread(target=self.__watch, daemon=True)
+            self.watcher.start()
+
+    def terminate(self):
+        self.watching = False
+        if self.listener:
+            self.listener.terminate()
+
+    def __take_over(self):
+        # 原agent已退出，由当前worker接替；只通知内容确实变化的配置
+        self.__claim()
+        self.is_agent = True
+        for ic, cc in self.caches:
+            config = super().get_config_raw(ic, refresh=True)
+            if config != cc.config:
+                cc.update((ic, cc), config)
+        self.__become_agent()
+
+    def __watch(self):
+        while self.watching:
+            sleep(self.watch_interval)
+            if self.is_agent:
+                continue
+            if self.holding_lock or tryLockFile(self.lock_fd):
+                self.holding_lock = True
+                try:
+                    self.__take_over()
+                except Exception:
+                    # 暂时无法访问Nacos，保持持锁并在下一轮重试
+                    self.is_agent = False
+                continue
+            if self.snapshot.version() == self.snapshot_version:
+                continue
+            version, configs = self.__read_snapshot()
+            self.snapshot_version = version
+            if configs is None:
+                continue
+            self.snapshot_configs = configs
+            for ic, cc in self.caches:
+                config = configs[cc.id]
+                if config != cc.config:
+                    cc.update((ic, cc), config)
+
+
+if __name__ == '__main__':
+    # 以独立进程运行agent，worker均以只读方式共享快照
+    client = SharedNacosClient()
+    if not client.is_agent:
+        raise RuntimeError(f'Another agent is holding {client.snapshot.path}.lock')
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        client.terminate()
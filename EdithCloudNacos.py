@@ -1,11 +1,15 @@
 import json
+import logging
 from hashlib import md5
+from importlib import import_module
 from os.path import exists
-from threading import Thread
-from typing import Callable, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Event, BoundedSemaphore
+from random import uniform
+from time import monotonic, time
+from typing import Callable, Tuple, List
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-import requests
-import yaml
 import re
 
 SUPPORTED_EXTENSION = ['yaml']
@@ -13,7 +17,41 @@ PROPERTIES_PATH = "static/properties.yml"
 WORD_SEPARATOR = u'\x02'
 LINE_SEPARATOR = u'\x01'
 PULLING_TIMEOUT = 30 * 1000
+MIN_PULLING_TIMEOUT = 5 * 1000
+LISTENER_CONNECT_TIMEOUT = 5
+LISTENER_READ_TIMEOUT_MARGIN = 10
+LISTENER_BACKOFF_BASE = 0.5
+LISTENER_BACKOFF_MAX = 60
+AUTH_LOGIN_TIMEOUT = 10
+AUTH_DEFAULT_TOKEN_TTL = 18000
+AUTH_REFRESH_RATIO = 0.8
+# Nacos因token本身失效返回403时响应中的提示
+AUTH_TOKEN_REJECTED = ['token invalid', 'token expired']
+BATCH_MAX_WORKERS = 16
+MICRO_CACHE_SIZE = 1024
 CHARACTER = 'utf-8'
+DEFAULT_FEEDBACK = ''
+
+logger = logging.getLogger(__name__)
+
+
+class LazyModule:
+    """
+    首次访问属性时才导入模块，避免只用到少量功能的脚本为requests、yaml的导入付出启动时间
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, item):
+        if self.module is None:
+            self.module = import_module(self.name)
+        return getattr(self.module, item)
+
+
+requests = LazyModule('requests')
+yaml = LazyModule('yaml')
 
 
 def dictToHttpRequestArgsStr(**kwargs):
@@ -44,6 +82,104 @@ def tokenizeHttpParams(s: str):
     return params
 
 
+class SingleFlight:
+    """
+    合并并发的相同请求：同一个key同时只有一个请求在执行，其余调用者等待并共享其结果。
+    micro_cache_ttl（秒）大于0时，结果会被短暂缓存以吸收紧随其后的重复请求。
+    结果会被多个调用者共享，应当是不可变的（如响应原文）。
+    """
+
+    class _Call:
+        def __init__(self, generation: int):
+            self.event = Event()
+            self.generation = generation
+            self.result = None
+            self.error = None
+
+    def __init__(self, micro_cache_ttl=0, micro_cache_size=MICRO_CACHE_SIZE):
+        self.micro_cache_ttl = micro_cache_ttl
+        self.micro_cache_size = micro_cache_size
+        self.lock = Lock()
+        self.calls = {}
+        self.cache = {}
+        self.generations = {}
+        self.next_sweep = 0
+
+    def do(self, key: str, f: Callable):
+        with self.lock:
+            if self.micro_cache_ttl > 0 and key in self.cache:
+                expire, result = self.cache[key]
+                if monotonic() < expire:
+                    return result
+                self.cache.pop(key)
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = SingleFlight._Call(self.generations.get(key, 0))
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = f()
+        except Exception as e:
+            call.error = e
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    self.calls.pop(key)
+                # forget之后才完成的请求可能拿到的是变更前的内容，不能放入缓存
+                if call.error is None and self.micro_cache_ttl > 0 and \
+                        call.generation == self.generations.get(key, 0):
+                    self.__put_cache(key, call.result)
+            call.event.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def __put_cache(self, key: str, result):
+        now = monotonic()
+        if now >= self.next_sweep:
+            # 定期清理过期条目，避免不再被请求的key一直占用内存
+            self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+            self.next_sweep = now + self.micro_cache_ttl
+        self.cache.pop(key, None)
+        while len(self.cache) >= self.micro_cache_size:
+            self.cache.pop(next(iter(self.cache)))
+        self.cache[key] = (now + self.micro_cache_ttl, result)
+
+    def forget(self, key: str):
+        with self.lock:
+            self.cache.pop(key, None)
+            self.generations[key] = self.generations.get(key, 0) + 1
+            # 正在执行的请求不再被新的调用者复用
+            self.calls.pop(key, None)
+
+
+def loadProperties(properties_path: str):
+    if not exists(properties_path):
+        raise FileNotFoundError(f'{properties_path} not found')
+    with open(properties_path) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def parseImportConfigs(properties: dict):
+    namespace = properties['spring']['cloud']['nacos']['config']['namespace']
+    extension = properties['spring']['cloud']['nacos']['config']['file-extension']
+    import_configs = []
+    for imp in properties['spring']['config']['import']:
+        temp = imp.split(':')[1].split('?')
+        dataId = temp[0]
+        params = tokenizeHttpParams(temp[1])
+        group = params['group']
+        import_configs.append(ImportConfig(dataId, namespace, extension, group))
+    return import_configs
+
+
 class ImportConfigError(Exception):
     def __init__(self, msg):
         self.msg = msg
@@ -64,11 +200,47 @@ class ImportConfig:
 
 
 class ConfigCache:
-    def __init__(self, import_config: ImportConfig, config=None):
-        self.config = config
+    def __init__(self, import_config: ImportConfig, config=None, loader: Callable = None,
+                 on_load: Callable = None):
+        """
+        :param loader: 懒加载时获取配置原文的函数，首次访问config时调用
+        :param on_load: 懒加载的配置首次获得内容后调用，参数为当前ConfigCache
+        """
+        self._config = config
+        self.loader = loader
+        self.on_load = on_load
+        self.lock = Lock()
         self.feedback_functions = {}
-        self.id = '%02'.join([import_config.dataId,
-                              import_config.group])
+        self.id = ConfigCache.composeId(import_config)
+
+    @property
+    def config(self):
+        if self.loader is not None:
+            with self.lock:
+                if self.loader is not None:
+                    self._config = self.loader()
+                    self.__loaded()
+        return self._config
+
+    @config.setter
+    def config(self, config):
+        self._config = config
+        if self.loader is not None:
+            self.__loaded()
+
+    def __loaded(self):
+        self.loader = None
+        if self.on_load is not None:
+            self.on_load(self)
+
+    @property
+    def loaded(self):
+        return self.loader is None
+
+    @staticmethod
+    def composeId(import_config: ImportConfig):
+        return '%02'.join([import_config.dataId,
+                           import_config.group])
 
     def add_feedback(self, name: str, f: Callable):
         self.feedback_functions[name] = f
@@ -80,104 +252,356 @@ class ConfigCache:
         for _, f in self.feedback_functions.items():
             f(key)
 
+    def update(self, key, config):
+        """
+        已经拿到新的配置原文时使用：直接更新并通知其余feedback，不再由默认feedback重复获取
+        """
+        self.config = config
+        for name, f in list(self.feedback_functions.items()):
+            if name != DEFAULT_FEEDBACK:
+                f(key)
+
+
+class NacosAuth:
+    """
+    requests的鉴权钩子，缓存/nacos/v1/auth/login获取的accessToken并附加到每个请求上。
+    token在tokenTtl到期前主动刷新，刷新期间其余线程继续使用旧token；并发的刷新只会登录一次。
+    """
+
+    def __init__(self, server_addr: str, username: str, password: str, refresh_ratio=AUTH_REFRESH_RATIO):
+        self.server_addr = server_addr
+        self.username = username
+        self.password = password
+        self.refresh_ratio = refresh_ratio
+        self.lock = Lock()
+        self.access_token = None
+        self.refresh_at = 0
+        self.expire_at = 0
+
+    @property
+    def enabled(self):
+        return bool(self.username)
+
+    def login(self):
+        response = requests.post(url=composeHttpSentence(self.server_addr, 'nacos/v1/auth/login'),
+                                 data={'username': self.username, 'password': self.password},
+                                 timeout=AUTH_LOGIN_TIMEOUT)
+        if response.status_code != 200:
+            result = f'Cannot login to Nacos(serverAddr={self.server_addr})'
+            raise ConnectionError(result + response.text)
+        body = json.loads(response.text)
+        now = monotonic()
+        ttl = body.get('tokenTtl', AUTH_DEFAULT_TOKEN_TTL)
+        self.access_token = body['accessToken']
+        self.refresh_at = now + ttl * self.refresh_ratio
+        self.expire_at = now + ttl
+        return self.access_token
+
+    def token(self):
+        if not self.enabled:
+            return None
+        now = monotonic()
+        if self.access_token and now < self.refresh_at:
+            return self.access_token
+        if self.access_token and now < self.expire_at:
+            # 即将过期：只由一个线程刷新，其余线程仍使用尚未过期的token
+            if not self.lock.acquire(blocking=False):
+                return self.access_token
+        else:
+            self.lock.acquire()
+        try:
+            if self.access_token and monotonic() < self.refresh_at:
+                return self.access_token
+            return self.login()
+        except Exception:
+            if self.access_token and monotonic() < self.expire_at:
+                return self.access_token
+            raise
+        finally:
+            self.lock.release()
+
+    def invalidate(self, token=None):
+        """
+        :param token: 被拒绝的token，只有它仍是当前token时才作废，避免并发请求作废刚刷新的token
+        """
+        with self.lock:
+            if token is None or token == self.access_token:
+                self.access_token = None
+
+    def __call__(self, r):
+        token = self.token()
+        if token:
+            r.prepare_url(r.url, {'accessToken': token})
+            r.register_hook('response', self.handle_forbidden)
+        return r
+
+    def handle_forbidden(self, r, **kwargs):
+        """
+        token被服务端拒绝（如服务端重启）时作废缓存的token，重新登录后重试一次。
+        没有权限等其他原因的403直接返回，不作废其他线程仍在使用的token
+        """
+        if r.status_code != 403 or getattr(r.request, 'nacos_retried', False):
+            return r
+        if not any(reason in r.text.lower() for reason in AUTH_TOKEN_REJECTED):
+            return r
+        url = urlsplit(r.request.url)
+        query = parse_qsl(url.query, keep_blank_values=True)
+        self.invalidate(dict(query).get('accessToken'))
+        token = self.token()
+        if not token:
+            return r
+
+        # 与requests的HTTPDigestAuth一样，释放连接后在同一连接池上重发
+        r.content
+        r.close()
+        prep = r.request.copy()
+        prep.prepare_url(urlunsplit(url._replace(query=urlencode([(k, v) for k, v in query
+                                                                   if k != 'accessToken']))),
+                         {'accessToken': token})
+        prep.nacos_retried = True
+        retried = r.connection.send(prep, **kwargs)
+        retried.history.append(r)
+        retried.request = prep
+        return retried
+
 
 class NacosListener:
-    def __init__(self, server_addr: str):
+    def __init__(self, server_addr: str, pulling_timeout=PULLING_TIMEOUT,
+                 fetch: Callable[[ImportConfig], str] = None, auth=None):
+        """
+        :param pulling_timeout: Long-Pulling-Timeout（毫秒），连接被提前断开时会自动缩短，成功后逐步恢复
+        :param fetch: 获取配置原文的函数，用于故障恢复后全量比对MD5
+        :param auth: NacosAuth，为监听请求附加accessToken
+        """
         self.server_addr = server_addr
+        self.auth = auth
+        self.pulling_timeout = pulling_timeout
+        self.current_timeout = pulling_timeout
+        self.fetch = fetch
         self.thread = None
         self.status = False
+        self.stop_event = Event()
         self.caches = {}
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self.last_success = None
+        self.last_feedback_error = None
 
     def put(self, import_config: ImportConfig, config_cache: ConfigCache):
         self.caches[config_cache.id] = (import_config, config_cache)
 
+    def health(self):
+        return {'alive': bool(self.thread and self.thread.is_alive()),
+                'healthy': self.healthy,
+                'failures': self.failures,
+                'last_error': self.last_error,
+                'last_success': self.last_success,
+                'last_feedback_error': self.last_feedback_error,
+                'pulling_timeout': self.current_timeout}
+
     def __tryResponse(self):
-        while True:
-            if not self.status:
-                return
-            id_list = []
-            for _, (import_config, config_cache) in self.caches.items():
-                key = WORD_SEPARATOR.join([f'{import_config.dataId}', import_config.group,
-                                           md5(config_cache.config.encode(CHARACTER)).hexdigest()
-                                           if config_cache.config else ''])
-                id_list.append(key)
+        id_list = []
+        for _, (import_config, config_cache) in list(self.caches.items()):
+            key = WORD_SEPARATOR.join([f'{import_config.dataId}', import_config.group,
+                                       md5(config_cache.config.encode(CHARACTER)).hexdigest()
+                                       if config_cache.config else ''])
+            id_list.append(key)
+        if not id_list:
+            # 懒加载模式下还没有配置被访问过
+            self.stop_event.wait(1)
+            return
+        start = monotonic()
+        try:
             self.__res = requests.post(url=composeHttpSentence(self.server_addr, 'nacos/v1/cs/configs/listener'),
                                        data={'Listening-Configs': LINE_SEPARATOR.join(id_list) + LINE_SEPARATOR},
-                                       headers={'Long-Pulling-Timeout': str(PULLING_TIMEOUT)})
-            if not self.__res.status_code == 200:
-                return self.__res
-            if self.__res.text:
-                lines = self.__res.text.split('%01\n')
-                for line in lines:
-                    if line:
-                        this = self.caches[line]
-                        this[1].poll(this)
-
-    def active(self):
+                                       headers={'Long-Pulling-Timeout': str(self.current_timeout)},
+                                       auth=self.auth,
+                                       timeout=(LISTENER_CONNECT_TIMEOUT,
+                                                self.current_timeout / 1000 + LISTENER_READ_TIMEOUT_MARGIN))
+        except requests.exceptions.RequestException:
+            if monotonic() - start >= MIN_PULLING_TIMEOUT / 1000:
+                # 长轮询等待中被服务端或中间代理断开，缩短下一次的Long-Pulling-Timeout
+                self.current_timeout = max(MIN_PULLING_TIMEOUT, self.current_timeout // 2)
+            raise
+        if not self.__res.status_code == 200:
+            raise ConnectionError(f'Listener of Nacos(serverAddr={self.server_addr}) responded '
+                                  f'{self.__res.status_code}: {self.__res.text}')
+        self.current_timeout = min(self.pulling_timeout, self.current_timeout * 3 // 2)
+        resynced = self.__recover() if not self.healthy else set()
+        if self.__res.text:
+            lines = self.__res.text.split('%01\n')
+            for line in lines:
+                this = self.caches.get(line)
+                # 恢复时已经全量比对过的配置不再重复获取和通知
+                if not this or line in resynced:
+                    continue
+                if self.fetch is None:
+                    self.__feedback(lambda: this[1].poll(this))
+                else:
+                    # 获取配置的异常属于Nacos故障，由外层退避重试
+                    config = self.fetch(this[0])
+                    if config != this[1].config:
+                        self.__feedback(lambda: this[1].update(this, config))
+
+    def __recover(self):
+        """
+        :return: 已经全量比对过的ConfigCache.id
+        """
+        if self.fetch is None:
+            self.healthy = True
+            return set()
+        # 故障期间可能错过了变更，全量比对；中途失败时下次成功后重新比对
+        resynced = set()
+        for cache_id, (import_config, config_cache) in list(self.caches.items()):
+            config = self.fetch(import_config)
+            if config != config_cache.config:
+                self.__feedback(lambda: config_cache.update((import_config, config_cache), config))
+            resynced.add(cache_id)
+        self.healthy = True
+        return resynced
+
+    def __feedback(self, f: Callable):
+        # feedback中的异常与Nacos无关，不影响监听器的健康状态和退避
+        try:
+            f()
+        except Exception as e:
+            self.last_feedback_error = repr(e)
+            logger.exception('Config feedback raised an exception')
+
+    def __listen(self):
+        while self.status:
+            try:
+                self.__tryResponse()
+                self.failures = 0
+                self.last_success = time()
+            except Exception as e:
+                self.healthy = False
+                self.failures += 1
+                self.last_error = repr(e)
+                # 带随机抖动的指数退避，避免所有客户端同时重连
+                delay = uniform(0, min(LISTENER_BACKOFF_MAX, LISTENER_BACKOFF_BASE * 2 ** min(self.failures, 16)))
+                self.stop_event.wait(delay)
+
+    def active(self, daemon=False):
         if not self.status:
             self.status = True
-            self.thread = Thread(target=self.__tryResponse)
+            self.stop_event.clear()
+            self.thread = Thread(target=self.__listen, daemon=daemon)
             self.thread.start()
 
     def terminate(self):
         self.status = False
+        self.stop_event.set()
 
 
 class NacosClient:
-    def __init__(self, properties_path=PROPERTIES_PATH):
+    def __init__(self, properties_path=PROPERTIES_PATH, micro_cache_ttl=0, lazy=False):
+        """
+        :param lazy: 为True时不在构造时下载配置，首次访问时才获取，且只监听被访问过的配置
+        """
+        self.lazy = lazy
         self.listener = None
         self.listenerHttpConn = None
-        if not exists(properties_path):
-            raise FileNotFoundError(f'{properties_path} not found')
-
-        properties = yaml.load(open(properties_path), Loader=yaml.FullLoader)
+        self.single_flight = SingleFlight(micro_cache_ttl)
+        properties = loadProperties(properties_path)
 
         self.name = properties['spring']['application']['name']
         self.config_import = properties['spring']['config']['import']
         self.serverAddr = properties['spring']['cloud']['nacos']['server-addr']
         self.nacos_username = properties['spring']['cloud']['nacos']['username']
         self.nacos_password = properties['spring']['cloud']['nacos']['password']
+        self.auth = NacosAuth(self.serverAddr, self.nacos_username, self.nacos_password)
+        self._http = None
+        self._executor = None
+        self.httpLock = Lock()
         self.fileExtension = properties['spring']['cloud']['nacos']['config']['file-extension']
         self.namespace = properties['spring']['cloud']['nacos']['config']['namespace']
+        self.pullingTimeout = properties['spring']['cloud']['nacos']['config'].get('long-pulling-timeout',
+                                                                                   PULLING_TIMEOUT)
 
         if self.fileExtension not in SUPPORTED_EXTENSION:
             raise ValueError('Unsupported file extension')
 
-        self.import_configs = []
-        for imp in self.config_import:
-            temp = imp.split(':')[1].split('?')
-            dataId = temp[0]
-            params = tokenizeHttpParams(temp[1])
-            group = params['group']
-            self.import_configs.append(ImportConfig(dataId, self.namespace, self.fileExtension, group))
+        self.import_configs = parseImportConfigs(properties)
 
         self.config_caches = []
         self.config_caches_mapping = {}
         for import_config in self.import_configs:
-            cc = ConfigCache(import_config, self.get_config_raw(import_config))
+            if lazy:
+                cc = ConfigCache(import_config, loader=lambda ic=import_config: self.get_config_raw(ic),
+                                 on_load=lambda c, ic=import_config: self.__listen_loaded(ic, c))
+            else:
+                cc = ConfigCache(import_config, self.get_config_raw(import_config))
             self.config_caches.append(cc)
-            cc.add_feedback('', self.__default_feedback_function)
+            cc.add_feedback(DEFAULT_FEEDBACK, self.__default_feedback_function)
             self.config_caches_mapping[cc.id] = cc
 
         self.caches = [(self.import_configs[i], self.config_caches[i]) for i in range(len(self.import_configs))]
 
-    def get_config_raw(self, import_config: ImportConfig):
-        args = dictToHttpRequestArgsStr(tenant=import_config.namespace,
-                                        dataId=import_config.dataId,
-                                        group=import_config.group)
-        response = requests.get(composeHttpSentence(self.serverAddr, f'nacos/v1/cs/configs?' + args))
-        if response.status_code != 200:
-            result = f'Cannot request config from Nacos(serverAddr={self.serverAddr})'
-            raise ConnectionError(result + response.text)
-        return response.text
-
-    def active_config_listener(self):
+    @property
+    def http(self):
+        """
+        复用连接的requests.Session，所有请求经由NacosAuth附加accessToken
+        """
+        if self._http is None:
+            with self.httpLock:
+                if self._http is None:
+                    session = requests.Session()
+                    session.auth = self.auth
+                    # 连接池容量与批量操作的并发数一致，避免连接被丢弃重建
+                    adapter = requests.adapters.HTTPAdapter(pool_maxsize=BATCH_MAX_WORKERS)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._http = session
+        return self._http
+
+    @property
+    def executor(self):
+        """
+        批量操作共享的线程池
+        """
+        if self._executor is None:
+            with self.httpLock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(BATCH_MAX_WORKERS, thread_name_prefix='nacos-batch')
+        return self._executor
+
+    def get_config_raw(self, import_config: ImportConfig, refresh=False):
+        router = 'nacos/v1/cs/configs' + dictToHttpRequestArgsStr(tenant=import_config.namespace,
+                                                                   dataId=import_config.dataId,
+                                                                   group=import_config.group)
+
+        def fetch():
+            response = self.http.get(composeHttpSentence(self.serverAddr, router))
+            if response.status_code != 200:
+                result = f'Cannot request config from Nacos(serverAddr={self.serverAddr})'
+                raise ConnectionError(result + response.text)
+            return response.text
+
+        if refresh:
+            # 配置已变更，不能复用变更前发出的请求或缓存的旧结果
+            self.single_flight.forget(router)
+            return fetch()
+        return self.single_flight.do(router, fetch)
+
+    def __singleFlightGetJson(self, router: str):
+        # 共享和缓存的是响应原文，每个调用者各自解析，避免修改结果时互相影响
+        return json.loads(self.single_flight.do(router, lambda: self.http.get(
+            url=composeHttpSentence(self.serverAddr, router)).text))
+
+    def active_config_listener(self, daemon=False):
         if not self.listener:
-            self.listener = NacosListener(self.serverAddr)
+            self.listener = NacosListener(self.serverAddr, self.pullingTimeout,
+                                          lambda ic: self.get_config_raw(ic, refresh=True), self.auth)
             for ic, cc in self.caches:
-                self.listener.put(ic, cc)
+                if cc.loaded:
+                    self.listener.put(ic, cc)
+
+        self.listener.active(daemon)
 
-        self.listener.active()
+    def listener_health(self):
+        return self.listener.health() if self.listener else None
 
     def get_config(self, index):
         if not 0 <= index < len(self.caches):
@@ -193,6 +617,11 @@ class NacosClient:
                 if ic.extension == 'yaml':
                     return yaml.load(cc.config, Loader=yaml.FullLoader)
 
+    def __listen_loaded(self, ic: ImportConfig, cc: ConfigCache):
+        if self.listener:
+            # 懒加载模式下配置首次被访问，加入已激活的监听器
+            self.listener.put(ic, cc)
+
     def match_config(self, name):
         result = []
         for ic in self.import_configs:
@@ -213,20 +642,33 @@ class NacosClient:
 
     def registerInstance(self, serviceName: str, ip: str, port: int, weight=None, enable=None, healthy=None,
                          metadata=None, groupName=None, clusterName=None, namespaceId=None, ephemeral=None):
-        return requests.post(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance'),
-                             data={ip: ip, port: port, namespaceId: namespaceId, weight: weight, enable: enable,
-                                   healthy: healthy, metadata: metadata, clusterName: clusterName,
-                                   serviceName: serviceName, groupName: groupName, ephemeral: ephemeral}).text
+        if isinstance(metadata, dict):
+            metadata = json.dumps(metadata)
+        return self.__checkInstanceResponse('register', self.http.post(
+            url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance'),
+            data={'ip': ip, 'port': port, 'namespaceId': namespaceId, 'weight': weight,
+                  'enable': enable, 'healthy': healthy, 'metadata': metadata,
+                  'clusterName': clusterName, 'serviceName': serviceName,
+                  'groupName': groupName, 'ephemeral': ephemeral}))
+
+    def registerInstances(self, instances: List[dict], max_workers=BATCH_MAX_WORKERS):
+        """
+        批量注册实例
+        :param instances: 每个元素为registerInstance的参数，如{'serviceName': 's', 'ip': '10.0.0.1', 'port': 80}
+        :param max_workers: 同时在途的请求数，最大为BATCH_MAX_WORKERS（共享线程池与连接池的容量）
+        :return: 与instances顺序一致的[(instance, result, error)]，Nacos返回非200时error为ConnectionError
+        """
+        return self.__batch(self.registerInstance, instances, max_workers)
 
     def publishConfig(self, data_id: str, content: str, type: str, group='DEFAULT_GROUP'):
         if self.fileExtension not in SUPPORTED_EXTENSION:
             raise ValueError('Unsupported file extension')
-        return bool(requests.post(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/configs'),
-                                  data={'dataId': data_id, 'group': group, 'content': content, 'type': type}).text)
+        return bool(self.http.post(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/configs'),
+                                   data={'dataId': data_id, 'group': group, 'content': content, 'type': type}).text)
 
     def deleteConfig(self, data_id: str, group='DEFAULT_GROUP'):
-        return bool(requests.delete(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/configs'),
-                                    data={'dataId': data_id, 'group': group}).text)
+        return bool(self.http.delete(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/configs'),
+                                     data={'dataId': data_id, 'group': group}).text)
 
     def getConfigHistory(self, dataId, group='DEFAULT_GROUP', tenant=None, pageNo=None, pageSize=None):
         """
@@ -253,13 +695,13 @@ class NacosClient:
           ]
         }
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/history' +
-                                                               dictToHttpRequestArgsStr(search='accurate',
-                                                                                        tenant=tenant,
-                                                                                        dataId=dataId,
-                                                                                        group=group,
-                                                                                        pageNo=pageNo,
-                                                                                        pageSize=pageSize))).text)
+        return json.loads(self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/history' +
+                                                                dictToHttpRequestArgsStr(search='accurate',
+                                                                                         tenant=tenant,
+                                                                                         dataId=dataId,
+                                                                                         group=group,
+                                                                                         pageNo=pageNo,
+                                                                                         pageSize=pageSize))).text)
 
     def queryConfigHistory(self, nid: int, dataId: str, group: str, tenant=None):
         """
@@ -279,11 +721,11 @@ class NacosClient:
           "lastModifiedTime": "2020-12-05T01:48:03.380+0000"
         }
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/history' +
-                                                               dictToHttpRequestArgsStr(nid=nid,
-                                                                                        tenant=tenant,
-                                                                                        dataId=dataId,
-                                                                                        group=group))).text)
+        return json.loads(self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/history' +
+                                                                dictToHttpRequestArgsStr(nid=nid,
+                                                                                         tenant=tenant,
+                                                                                         dataId=dataId,
+                                                                                         group=group))).text)
 
     def queryPreviousConfigHistory(self, id: int, dataId: str, group: str, tenant=None):
         """
@@ -303,33 +745,71 @@ class NacosClient:
           "lastModifiedTime": "2020-12-05T01:48:03.380+0000"
         }
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/history/previous' +
-                                                               dictToHttpRequestArgsStr(id=id,
-                                                                                        tenant=tenant,
-                                                                                        dataId=dataId,
-                                                                                        group=group))).text)
+        return json.loads(self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/cs/history/previous' +
+                                                                dictToHttpRequestArgsStr(id=id,
+                                                                                         tenant=tenant,
+                                                                                         dataId=dataId,
+                                                                                         group=group))).text)
 
     def deleteInstance(self, serviceName: str, ip: str, port: int,
                        groupName=None, clusterName=None, namespaceId=None, ephemeral=None):
-        return requests.delete(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance' +
-                                                       dictToHttpRequestArgsStr(**{serviceName: serviceName,
-                                                                                   groupName: groupName, ip: ip,
-                                                                                   port: port,
-                                                                                   clusterName: clusterName,
-                                                                                   namespaceId: namespaceId,
-                                                                                   ephemeral: ephemeral}))).text
+        return self.__checkInstanceResponse('delete', self.http.delete(
+            url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance' +
+                                    dictToHttpRequestArgsStr(serviceName=serviceName,
+                                                             groupName=groupName, ip=ip,
+                                                             port=port,
+                                                             clusterName=clusterName,
+                                                             namespaceId=namespaceId,
+                                                             ephemeral=ephemeral))))
+
+    def deleteInstances(self, instances: List[dict], max_workers=BATCH_MAX_WORKERS):
+        """
+        批量注销实例，instances中每个元素为deleteInstance的参数，max_workers同registerInstances
+        :return: 与instances顺序一致的[(instance, result, error)]
+        """
+        return self.__batch(self.deleteInstance, instances, max_workers)
 
     def updateInstance(self, serviceName: str, ip: str, port: int, weight=None, enable=None, healthy=None,
                        metadata=None, groupName=None, clusterName=None, namespaceId=None, ephemeral=None):
-        return requests.put(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance' +
-                                                    dictToHttpRequestArgsStr(**{ip: ip, port: port,
-                                                                                namespaceId: namespaceId,
-                                                                                weight: weight, enable: enable,
-                                                                                healthy: healthy, metadata: metadata,
-                                                                                clusterName: clusterName,
-                                                                                serviceName: serviceName,
-                                                                                groupName: groupName,
-                                                                                ephemeral: ephemeral}))).text
+        if isinstance(metadata, dict):
+            metadata = json.dumps(metadata)
+        # metadata为json，交给requests做url编码
+        return self.__checkInstanceResponse('update', self.http.put(
+            url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance'),
+            params={'ip': ip, 'port': port, 'namespaceId': namespaceId, 'weight': weight,
+                    'enable': enable, 'healthy': healthy, 'metadata': metadata,
+                    'clusterName': clusterName, 'serviceName': serviceName,
+                    'groupName': groupName, 'ephemeral': ephemeral}))
+
+    def __checkInstanceResponse(self, action: str, response):
+        if response.status_code != 200:
+            result = f'Cannot {action} instance on Nacos(serverAddr={self.serverAddr}, status={response.status_code})'
+            raise ConnectionError(result + response.text)
+        return response.text
+
+    def updateInstances(self, instances: List[dict], max_workers=BATCH_MAX_WORKERS):
+        """
+        批量更新实例，instances中每个元素为updateInstance的参数，max_workers同registerInstances
+        :return: 与instances顺序一致的[(instance, result, error)]
+        """
+        return self.__batch(self.updateInstance, instances, max_workers)
+
+    def __batch(self, f: Callable, instances: List[dict], max_workers: int):
+        def call(instance):
+            try:
+                return instance, f(**instance), None
+            except Exception as e:
+                return instance, None, e
+
+        # 在共享线程池上执行，Semaphore限制本次批量同时在途的请求数，超过线程池容量的部分不会带来更多并发
+        semaphore = BoundedSemaphore(max(1, min(max_workers, BATCH_MAX_WORKERS)))
+        futures = []
+        for instance in instances:
+            semaphore.acquire()
+            future = self.executor.submit(call, instance)
+            future.add_done_callback(lambda _: semaphore.release())
+            futures.append(future)
+        return [future.result() for future in futures]
 
     def queryInstanceList(self, serviceName: str, groupName=None, namespaceId=None, clusters=None, healthyOnly=None):
         """
@@ -363,13 +843,12 @@ class NacosClient:
           "valid": true
         }
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance/list' +
-                                                               dictToHttpRequestArgsStr(serviceName=serviceName,
-                                                                                        groupName=groupName,
-                                                                                        namespaceId=namespaceId,
-                                                                                        clusters=clusters,
-                                                                                        healthyOnly=healthyOnly)
-                                                               )).text)
+        return self.__singleFlightGetJson('nacos/v1/ns/instance/list' +
+                                          dictToHttpRequestArgsStr(serviceName=serviceName,
+                                                                   groupName=groupName,
+                                                                   namespaceId=namespaceId,
+                                                                   clusters=clusters,
+                                                                   healthyOnly=healthyOnly))
 
     def queryInstance(self, serviceName: str, ip: str, port: str, groupName=None, namespaceId=None,
                       clusters=None, healthyOnly=None):
@@ -385,29 +864,28 @@ class NacosClient:
             "weight": 1.0
         }
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance' +
-                                                               dictToHttpRequestArgsStr(serviceName=serviceName,
-                                                                                        groupName=groupName,
-                                                                                        ip=ip,
-                                                                                        port=port,
-                                                                                        namespaceId=namespaceId,
-                                                                                        clusters=clusters,
-                                                                                        healthyOnly=healthyOnly)
-                                                               )).text)
+        return self.__singleFlightGetJson('nacos/v1/ns/instance' +
+                                          dictToHttpRequestArgsStr(serviceName=serviceName,
+                                                                   groupName=groupName,
+                                                                   ip=ip,
+                                                                   port=port,
+                                                                   namespaceId=namespaceId,
+                                                                   clusters=clusters,
+                                                                   healthyOnly=healthyOnly))
 
     def beatInstance(self, serviceName: str, ip: str, port: str, beat, namespaceId=None, groupName=None,
                      ephemeral=None):
         if beat is not str:
             beat = json.dumps(beat)
-        return requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance/beat' +
-                                                    dictToHttpRequestArgsStr(serviceName=serviceName,
-                                                                             ip=ip,
-                                                                             port=port,
-                                                                             namespaceId=namespaceId,
-                                                                             groupName=groupName,
-                                                                             ephemeral=ephemeral,
-                                                                             beat=beat)
-                                                    )).text
+        return self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/instance/beat' +
+                                                     dictToHttpRequestArgsStr(serviceName=serviceName,
+                                                                              ip=ip,
+                                                                              port=port,
+                                                                              namespaceId=namespaceId,
+                                                                              groupName=groupName,
+                                                                              ephemeral=ephemeral,
+                                                                              beat=beat)
+                                                     )).text
 
     def createService(self, serviceName: str, groupName=None, namespaceId=None,
                       protectThreshold=None, metadata=None, selector=None):
@@ -415,21 +893,21 @@ class NacosClient:
             raise ValueError('ProtectThreshold must be between 0 and 1')
         if selector is not str:
             selector = json.dumps(selector)
-        return requests.post(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service'),
-                             data={
-                                 serviceName: serviceName,
-                                 groupName: groupName,
-                                 namespaceId: namespaceId,
-                                 protectThreshold: protectThreshold,
-                                 metadata: metadata,
-                                 selector: selector
-                             })
+        return self.http.post(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service'),
+                              data={
+                                  'serviceName': serviceName,
+                                  'groupName': groupName,
+                                  'namespaceId': namespaceId,
+                                  'protectThreshold': protectThreshold,
+                                  'metadata': metadata,
+                                  'selector': selector
+                              })
 
     def deleteService(self, serviceName: str, groupName=None, namespaceId=None):
-        return requests.delete(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service' +
-                                                       dictToHttpRequestArgsStr(serviceName=serviceName,
-                                                                                groupName=groupName,
-                                                                                namespaceId=namespaceId))).text
+        return self.http.delete(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service' +
+                                                        dictToHttpRequestArgsStr(serviceName=serviceName,
+                                                                                 groupName=groupName,
+                                                                                 namespaceId=namespaceId))).text
 
     def updateService(self, serviceName: str, groupName=None, namespaceId=None,
                       protectThreshold=None, metadata=None, selector=None):
@@ -437,15 +915,15 @@ class NacosClient:
             raise ValueError('ProtectThreshold must be between 0 and 1')
         if selector is not str:
             selector = json.dumps(selector)
-        return requests.put(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service'),
-                            data={
-                                serviceName: serviceName,
-                                groupName: groupName,
-                                namespaceId: namespaceId,
-                                protectThreshold: protectThreshold,
-                                metadata: metadata,
-                                selector: selector
-                            })
+        return self.http.put(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service'),
+                             data={
+                                 'serviceName': serviceName,
+                                 'groupName': groupName,
+                                 'namespaceId': namespaceId,
+                                 'protectThreshold': protectThreshold,
+                                 'metadata': metadata,
+                                 'selector': selector
+                             })
 
     def queryService(self, serviceName: str, groupName=None, namespaceId=None):
         """
@@ -473,10 +951,10 @@ class NacosClient:
         :param namespaceId:
         :return:
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service' +
-                                                               dictToHttpRequestArgsStr(serviceName=serviceName,
-                                                                                        groupName=groupName,
-                                                                                        namespaceId=namespaceId))).text)
+        return self.__singleFlightGetJson('nacos/v1/ns/service' +
+                                          dictToHttpRequestArgsStr(serviceName=serviceName,
+                                                                   groupName=groupName,
+                                                                   namespaceId=namespaceId))
 
     def queryServiceList(self, pageNo: int, pageSize: int, groupName=None, namespaceId=None):
         """
@@ -493,11 +971,11 @@ class NacosClient:
         :param namespaceId:
         :return:
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service/list' +
-                                                               dictToHttpRequestArgsStr(pageNo=pageNo,
-                                                                                        pageSize=pageSize,
-                                                                                        groupName=groupName,
-                                                                                        namespaceId=namespaceId))).text)
+        return json.loads(self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/service/list' +
+                                                                dictToHttpRequestArgsStr(pageNo=pageNo,
+                                                                                         pageSize=pageSize,
+                                                                                         groupName=groupName,
+                                                                                         namespaceId=namespaceId))).text)
 
     def querySwitch(self):
         """
@@ -548,13 +1026,13 @@ class NacosClient:
         }
         :return:
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/switches')).text)
+        return json.loads(self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/switches')).text)
 
     def updateSwitch(self, entry: str, value: str, debug=None):
-        return requests.put(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/switches' +
-                                                    dictToHttpRequestArgsStr(entry=entry,
-                                                                             value=value,
-                                                                             debug=debug))).text
+        return self.http.put(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/switches' +
+                                                     dictToHttpRequestArgsStr(entry=entry,
+                                                                              value=value,
+                                                                              debug=debug))).text
 
     def queryMetrics(self):
         """
@@ -570,7 +1048,7 @@ class NacosClient:
         }
         :return:
         """
-        return json.loads(requests.get(composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/metrics')).text)
+        return json.loads(self.http.get(composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/metrics')).text)
 
     def queryServerList(self, healthy=None):
         """
@@ -614,8 +1092,8 @@ class NacosClient:
         :param healthy:
         :return:
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/servers' +
-                                                               dictToHttpRequestArgsStr(healthy=healthy))).text)
+        return json.loads(self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/operator/servers' +
+                                                                dictToHttpRequestArgsStr(healthy=healthy))).text)
 
     def queryLeader(self):
         """
@@ -624,17 +1102,17 @@ class NacosClient:
         }
         :return:
         """
-        return json.loads(requests.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/raft/leader')).text)
+        return json.loads(self.http.get(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/raft/leader')).text)
 
     def updateInstanceHealthy(self, serviceName: str, ip: str, port: int, healthy: bool,
                               namespaceId=None, groupName=None, clusterName=None):
-        return requests.put(requests.put(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/health/instance' +
-                                                                 dictToHttpRequestArgsStr(namespaceId=namespaceId,
-                                                                                          serviceName=serviceName,
-                                                                                          groupName=groupName,
-                                                                                          clusterName=clusterName,
-                                                                                          ip=ip, port=port,
-                                                                                          healthy=healthy))).text)
+        return self.http.put(url=composeHttpSentence(self.serverAddr, 'nacos/v1/ns/health/instance' +
+                                                     dictToHttpRequestArgsStr(namespaceId=namespaceId,
+                                                                              serviceName=serviceName,
+                                                                              groupName=groupName,
+                                                                              clusterName=clusterName,
+                                                                              ip=ip, port=port,
+                                                                              healthy=healthy))).text
 
     def __default_feedback_function(self, cc: Tuple[ImportConfig, ConfigCache]):
-        cc[1].config = self.get_config_raw(cc[0])
+        cc[1].config = self.get_config_raw(cc[0], refresh=True)
@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import codecs
+import json
+import os
+import socket
+import subprocess
+import sys
+from bisect import bisect_left
+from time import perf_counter, sleep
+
+import httpx
+
+# 直方图桶的上界（毫秒）
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+# 直方图桶的上界（MB/s）
+THROUGHPUT_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000]
+SIZE_UNITS = {'k': 1024, 'm': 1024 * 1024}
+
+
+class Histogram:
+    def __init__(self, name: str, unit: str, buckets):
+        self.name = name
+        self.unit = unit
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.values = []
+
+    def record(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.values.append(value)
+
+    def percentile(self, p):
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    def __str__(self):
+        if not self.values:
+            return f'{self.name}: no samples'
+        lines = [f'{self.name} ({self.unit}) n={len(self.values)} '
+                 f'p50={self.percentile(50):.2f} p90={self.percentile(90):.2f} '
+                 f'p99={self.percentile(99):.2f} max={max(self.values):.2f}']
+        most = max(self.counts)
+        for i, count in enumerate(self.counts):
+            if not count:
+                continue
+            bound = f'<={self.buckets[i]}' if i < len(self.buckets) else f'>{self.buckets[-1]}'
+            lines.append(f'  {bound:>8} {count:>7} {"#" * max(1, count * 40 // most)}')
+        return '\n'.join(lines)
+
+
+class LoadStats:
+    def __init__(self):
+        self.first_event = Histogram('time-to-first-event', 'ms', LATENCY_BUCKETS)
+        self.inter_event = Histogram('inter-event latency', 'ms', LATENCY_BUCKETS)
+        self.upload = Histogram('upload throughput', 'MB/s', THROUGHPUT_BUCKETS)
+        self.requests = 0
+        self.errors = {}
+
+    def error(self, e):
+        key = type(e).__name__ if not isinstance(e, str) else e
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def __str__(self):
+        lines = [f'requests={self.requests} errors={sum(self.errors.values())} {self.errors or ""}',
+                 str(self.first_event), str(self.inter_event), str(self.upload)]
+        return '\n'.join(lines)
+
+
+def parseSize(s: str):
+    s = s.strip().lower()
+    if s[-1] in SIZE_UNITS:
+        return int(float(s[:-1]) * SIZE_UNITS[s[-1]])
+    return int(s)
+
+
+def parseMix(s: str):
+    """
+    'contact=3' -> [('contact', 3)]
+    """
+    mix = []
+    for item in s.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f'Unknown scenario {name}, expected one of {list(SCENARIOS)}')
+        weight = int(weight or 1)
+        if weight <= 0:
+            raise ValueError(f'Weight of scenario {name} must be greater than 0')
+        mix.append((name, weight))
+    return mix
+
+
+class EventSplitter:
+    """
+    把传输层的chunk还原成事件：SSE格式按空行分帧，event_generator输出的连续json按对象边界切分
+    """
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json = json.JSONDecoder()
+        self.buffer = ''
+
+    def feed(self, chunk: bytes):
+        """
+        :return: 本次chunk中完整事件的数量
+        """
+        self.buffer += self.decoder.decode(chunk)
+        events = 0
+        while True:
+            self.buffer = self.buffer.lstrip()
+            if not self.buffer:
+                return events
+            if self.buffer[0] in '{[':
+                try:
+                    _, end = self.json.raw_decode(self.buffer)
+                except json.JSONDecodeError:
+                    return events
+            else:
+                end = self.buffer.find('\n\n')
+                if end < 0:
+                    return events
+                end += 2
+            self.buffer = self.buffer[end:]
+            events += 1
+
+
+async def readEvents(response: httpx.Response, stats: LoadStats, start: float):
+    """
+    :param start: 响应头到达的时间，首个事件延迟从这里开始计算，不包含上传耗时
+    """
+    splitter = EventSplitter()
+    last = None
+    async for chunk in response.aiter_raw():
+        now = perf_counter()
+        for _ in range(splitter.feed(chunk)):
+            if last is None:
+                stats.first_event.record((now - start) * 1000)
+            else:
+                stats.inter_event.record((now - last) * 1000)
+            last = now
+    if last is None:
+        stats.error('empty stream')
+
+
+async def contact(client: httpx.AsyncClient, stats: LoadStats, size: int):
+    payload = os.urandom(size)
+    start = perf_counter()
+    async with client.stream('POST', '/contact', files={'file': (f'load-{size}.bin', payload)}) as response:
+        # 响应头到达时上传已经被服务端读完
+        headers_at = perf_counter()
+        stats.upload.record(size / (1024 * 1024) / max(headers_at - start, 1e-9))
+        if response.status_code != 200:
+            stats.error(f'HTTP {response.status_code}')
+            return
+        await readEvents(response, stats, headers_at)
+
+
+SCENARIOS = {'contact': contact}
+
+
+async def worker(client: httpx.AsyncClient, stats: LoadStats, jobs: asyncio.Queue):
+    while True:
+        try:
+            scenario, size = jobs.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        stats.requests += 1
+        try:
+            await SCENARIOS[scenario](client, stats, size)
+        except httpx.HTTPError as e:
+            stats.error(e)
+
+
+async def run(url: str, clients: int, total: int, mix, sizes, timeout: float):
+    # 按权重和payload大小轮流生成请求，保证各场景的比例稳定
+    plan = [(name, size) for name, weight in mix for _ in range(weight) for size in sizes]
+    jobs = asyncio.Queue()
+    for i in range(total):
+        jobs.put_nowait(plan[i % len(plan)])
+
+    stats = LoadStats()
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+        start = perf_counter()
+        await asyncio.gather(*(worker(client, stats, jobs) for _ in range(clients)))
+        elapsed = perf_counter() - start
+    print(f'{url} clients={clients} elapsed={elapsed:.2f}s rate={stats.requests / elapsed:.1f} req/s')
+    print(stats)
+    return stats
+
+
+def waitPort(host: str, port: int, timeout: float):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            with socket.create_connection((host, port), 0.5):
+                return
+        except OSError:
+            sleep(0.2)
+    raise TimeoutError(f'{host}:{port} is not listening')
+
+
+def spawnApp(port: int, workers: int):
+    """
+    以指定worker数启动本地的Application:app
+    """
+    os.makedirs('test', exist_ok=True)
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'Application:app', '--host', '127.0.0.1',
+                                '--port', str(port), '--workers', str(workers), '--log-level', 'warning'])
+    try:
+        waitPort('127.0.0.1', port, 60)
+    except TimeoutError:
+        process.terminate()
+        raise
+    return process
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='上传与EventStream接口的并发压测')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--clients', type=int, default=32, help='并发客户端数')
+    parser.add_argument('--requests', type=int, default=1000, help='请求总数')
+    parser.add_argument('--mix', default='contact=1', help='请求比例，如contact=3')
+    parser.add_argument('--sizes', default='1k,64k,1m', help='上传payload大小')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--spawn-workers', type=int, default=0,
+                        help='大于0时在--url的端口上以该worker数启动本地Application:app')
+    args = parser.parse_args()
+
+    app_process = None
+    if args.spawn_workers > 0:
+        app_process = spawnApp(httpx.URL(args.url).port or 80, args.spawn_workers)
+    try:
+        asyncio.run(run(args.url, args.clients, args.requests, parseMix(args.mix),
+                        [parseSize(s) for s in args.sizes.split(',')], args.timeout))
+    finally:
+        if app_process:
+            app_process.terminate()
+            app_process.wait()